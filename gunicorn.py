@@ -16,8 +16,11 @@
 """Configure the gunicorn server."""
 
 import os
+import subprocess
+import sys
 
 _config = os.environ["ENVIRONMENT"]
+_predictor_supervisor = []
 
 bind = "0.0.0.0:8000"
 worker_class = "aiohttp.worker.GunicornWebWorker"
@@ -28,7 +31,29 @@ accesslog = "-"
 if _config == "production":
     workers = os.cpu_count() * 2 + 1
     loglevel = "DEBUG"
+    _predictor_servers = int(os.environ.get("PREDICTOR_SERVER_PROCESSES", 1))
 else:
     workers = 1
     reload = True
     loglevel = "DEBUG"
+    _predictor_servers = int(os.environ.get("PREDICTOR_SERVER_PROCESSES", 0))
+
+
+def on_starting(server):
+    """
+    Start the node's predictor servers, so that predictors are held once per node instead of once per worker.
+    A supervisor process restarts servers that die. Workers are forked afterwards and find the servers through
+    the PREDICTOR_SERVERS environment variable.
+    """
+    addresses = ["ipc:///tmp/metabolic-ninja-predictor-{}".format(i) for i in range(_predictor_servers)]
+    if addresses:
+        command = [sys.executable, "-m", "metabolic_ninja.predictor_server", "--supervise"]
+        for address in addresses:
+            command += ["--bind", address]
+        _predictor_supervisor.append(subprocess.Popen(command))
+        os.environ["PREDICTOR_SERVERS"] = ",".join(addresses)
+
+
+def on_exit(server):
+    for process in _predictor_supervisor:
+        process.terminate()
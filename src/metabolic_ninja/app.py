@@ -14,192 +14,128 @@
 
 import logging
 import os
-import copy
-from datetime import datetime, timedelta
-import time
+import socket
+import uuid
 import asyncio
-import requests
-import sys
-import traceback
-import json
-from copy import deepcopy
-from functools import partial
 import aiohttp_cors
-import cobra
 from aiohttp import web, WSMsgType
-from pymongo import MongoClient, ASCENDING
-from metabolic_ninja.pathway_graph import PathwayGraph
-from metabolic_ninja.mongo_client import MongoDB, PathwayCollection, MONGO_CRED
-from metabolic_ninja.pickle_predictors import get_predictor
+from motor.motor_asyncio import AsyncIOMotorClient
+from metabolic_ninja.mongo_client import AsyncMongoDB, AsyncPathwayCollection, MONGO_CRED
+from metabolic_ninja.catalog import CatalogIndex
+from metabolic_ninja.job_runner import create_job_runner
 from metabolic_ninja.middleware import raven_middleware
 from metabolic_ninja.healthz import healthz
-from . import raven_client
+from . import settings
 
 
 logger = logging.getLogger(__name__)
 
-MAX_PREDICTIONS = 10
+MONGO_CLIENT = AsyncIOMotorClient(*MONGO_CRED, maxPoolSize=None)
 
-TIMEOUT = timedelta(minutes=30)
+CATALOG = CatalogIndex(AsyncMongoDB(mongo_client=MONGO_CLIENT))
 
+JOB_RUNNER = create_job_runner()
 
-MONGO_CLIENT = MongoClient(*MONGO_CRED, maxPoolSize=None)
 
-
-def pathway_to_model(pathway):
-    model = cobra.Model('test')
-    model.add_reactions(deepcopy(list(pathway.reactions)))
-    return json.loads(cobra.io.to_json(model))
-
-
-def pathway_to_list(pathway):
-    return [reaction_to_dict(reaction) for reaction in pathway.reactions]
+def parse_max_predictions(value):
+    """Validate a requested number of pathways, e.g. from a query string or a websocket message; raise ValueError"""
+    try:
+        max_predictions = int(value)
+    except (TypeError, ValueError):
+        # e.g. a list or an object in a websocket message
+        raise ValueError("max_predictions must be an integer, not {!r}".format(value))
+    if not 1 <= max_predictions <= settings.MAX_PREDICTIONS_LIMIT:
+        raise ValueError("max_predictions must be between 1 and {}".format(settings.MAX_PREDICTIONS_LIMIT))
+    return max_predictions
 
 
-def reaction_to_dict(reaction):
-    return dict(
-        id=reaction.id,
-        name=reaction.name,
-        reaction_string=reaction.build_reaction_string(use_metabolite_names=True),
-    )
+def requested_max_predictions(request, default=settings.DEFAULT_MAX_PREDICTIONS):
+    try:
+        return parse_max_predictions(request.GET.get('max_predictions', default))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
 
 
-def metabolite_to_dict(metabolite):
-    return dict(
-        id=metabolite.id,
-        name=metabolite.name,
-        formula=metabolite.formula,
+def prediction_is_ready(product_document, max_predictions):
+    """The first `max_predictions` pathways, or all pathways there are, are stored"""
+    return product_document and (
+        len(product_document['pathways']) >= max_predictions or
+        (product_document['ready'] and product_document.get('exhausted', False))
     )
 
 
-def prediction_has_failed(product_document):
-    return product_document and (not product_document['ready']) and \
-           (datetime.now() - product_document['updated'] >= TIMEOUT)
-
-
-def prediction_is_ready(product_document):
-    return product_document and product_document['ready']
-
-
-def start_prediction(mongo_client):
-    mongo_client.upsert()
-    loop = asyncio.get_event_loop()
-    loop.create_task(predict_pathways(mongo_client.key))
-
-
-def bigg_ids(object_ids):
-    query = json.dumps({'ids': object_ids, 'dbFrom': 'mnx', 'dbTo': 'bigg', 'type': 'Metabolite'})
-    r = requests.post(os.environ['ID_MAPPER_API'], data=query)
-    return r.json()['ids']
-
-
-def append_pathway(mongo_client, pathway):
-    logger.debug("Pathway is ready, adding to mongo: {}".format(mongo_client.key))
-    pathway = map_metabolites_ids_to_bigg(pathway)
-    pathway_graph = PathwayGraph(pathway, mongo_client.product_id)
-    reactions_list = [reaction_to_dict(reaction) for reaction in pathway_graph.sorted_reactions]
-    primary_nodes = [metabolite_to_dict(metabolite) for metabolite in pathway_graph.sorted_primary_nodes]
-    mongo_client.append_pathway(reactions_list, pathway_to_model(pathway), primary_nodes)
-
-
-def map_metabolites_ids_to_bigg(pathway_original):
-    pathway = copy.deepcopy(pathway_original)
-    all_met_ids = bigg_ids(
-        [met.id for reaction in pathway.reactions for met in
-         reaction.metabolites])
-    for reaction in pathway.reactions:
-        for metabolite in reaction.metabolites:
-            metabolite.id = all_met_ids[metabolite.id][0] + '_c' \
-                if metabolite.id in all_met_ids else metabolite.id
-    return pathway
+def lease_owner():
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
 
 
 async def run_predictor(request):
     key = {attr: request.GET[attr] for attr in ('product_id', 'model_id', 'universal_model_id', 'carbon_source_id')}
-    product_exists = MongoDB(mongo_client=MONGO_CLIENT).is_available(**key)
+    max_predictions = requested_max_predictions(request)
+    product_exists = await CATALOG.is_available(**key)
     if not product_exists:
         return web.HTTPNotFound(text="No such key")
-    mongo_client = PathwayCollection(key, mongo_client=MONGO_CLIENT)
-    product_document = mongo_client.find()
-    logger.info("New prediction request: {}".format(key))
+    mongo_client = AsyncPathwayCollection(key, mongo_client=MONGO_CLIENT)
+    product_document = await mongo_client.find()
+    logger.info("New prediction request for {} pathways: {}".format(max_predictions, key))
 
-    if prediction_is_ready(product_document):
+    if prediction_is_ready(product_document, max_predictions):
         logger.debug("Cached prediction already exists: {}".format(key))
         return web.HTTPOk(text="Ready")
 
-    if prediction_has_failed(product_document):
-        logger.debug("Prediction has failed; restarting: {}".format(key))
-        mongo_client.remove()
-        start_prediction(mongo_client)
-        return web.HTTPAccepted(text="Prediction failed, restarting")
+    owner = lease_owner()
+    previous_document = await mongo_client.claim(owner, settings.LEASE_TTL, max_predictions)
+    if previous_document is None:
+        logger.debug("Prediction already in progress: {}".format(key))
+        return web.HTTPAccepted(text="Already in progress")
 
-    if not product_document:
+    JOB_RUNNER.submit(mongo_client, owner)
+    if previous_document.get('lease'):
+        logger.debug("Prediction lease has expired; restarting: {}".format(key))
+        return web.HTTPAccepted(text="Prediction failed, restarting")
+    elif previous_document['pathways']:
+        logger.debug("Extending prediction after {} pathways: {}".format(len(previous_document['pathways']), key))
+        return web.HTTPAccepted(text="Accepted, extending")
+    else:
         logger.debug("Starting new prediction: {}".format(key))
-        start_prediction(mongo_client)
         return web.HTTPAccepted(text="Accepted")
-    else:
-        logger.debug("Prediction already in progress (or not yet timed out): {}".format(key))
-        return web.HTTPAccepted(text="Already in progress (or not yet timed out)")
 
 
 async def pathways(request):
     key = {attr: request.GET[attr] for attr in ('product_id', 'model_id', 'universal_model_id', 'carbon_source_id')}
-    mongo_client = PathwayCollection(key, mongo_client=MONGO_CLIENT)
-    product_document = mongo_client.find()
+    max_predictions = requested_max_predictions(request, default=settings.MAX_PREDICTIONS_LIMIT)
+    mongo_client = AsyncPathwayCollection(key, mongo_client=MONGO_CLIENT)
+    product_document = await mongo_client.find()
     result = []
     if product_document:
-        result = product_document['pathways']
+        result = product_document['pathways'][:max_predictions]
     return web.json_response(result)
 
 
-def json_response(collection):
-    return web.json_response([{'id': m['_id'], 'name': m['name']} for m in collection])
+def json_response(request, body):
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        return web.Response(body=body.gzipped, content_type='application/json',
+                            headers={'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+    return web.Response(body=body.json, content_type='application/json', headers={'Vary': 'Accept-Encoding'})
 
 
 async def universal_model_list(request):
-    return json_response(MongoDB(mongo_client=MONGO_CLIENT).universal_models.find())
+    return json_response(request, await CATALOG.list_body('universal_model'))
 
 
 async def carbon_source_list(request):
-    return json_response(MongoDB(mongo_client=MONGO_CLIENT).carbon_sources.find())
+    return json_response(request, await CATALOG.list_body('carbon_source'))
 
 
 async def model_list(request):
-    return json_response(MongoDB(mongo_client=MONGO_CLIENT).models.find())
+    return json_response(request, await CATALOG.list_body('model'))
 
 
 async def product_list(request):
     universal_model = request.GET['universal_model_id']
-    return json_response(MongoDB(mongo_client=MONGO_CLIENT).products.find({'universal_models': {'$in': [universal_model]}}))
-
-
-async def predict_pathways(key: dict):
-    t = time.time()
-    logger.info("Starting prediction job: {}".format(key))
-    mongo_client = PathwayCollection(key, mongo_client=MONGO_CLIENT)
-    mongo_client.pathways.create_index([(k, ASCENDING) for k in key])
-    try:
-        logger.debug("Getting predictor: {}".format(key))
-        predictor = get_predictor(mongo_client.model_id, mongo_client.universal_model_id)
-        logger.debug("Starting pathway prediction: {}".format(key))
-        predictor.run(
-            product=mongo_client.product_id,
-            max_predictions=MAX_PREDICTIONS,
-            callback=partial(append_pathway, mongo_client),
-        )
-    except Exception:
-        raven_client.captureException()
-        logger.error("Error during pathway prediction; removing key from mongodb: {}".format(key))
-        mongo_client.remove()
-        raise
-    else:
-        logger.debug("Prediction complete in {:.2f}s: {}".format(time.time() - t, key))
-        mongo_client.set_ready()
+    return json_response(request, await CATALOG.product_list_body(universal_model))
 
 
 async def ws_handler(request):
-    logger.info(get_predictor.cache_info())
-    mongodb = MongoDB(mongo_client=MONGO_CLIENT)
     ws = web.WebSocketResponse()
     await ws.prepare(request)
     try:
@@ -210,16 +146,22 @@ async def ws_handler(request):
                     await ws.close()
                 else:
                     key = msg.json()
-                    product_exists = mongodb.is_available(**key)
+                    try:
+                        max_predictions = parse_max_predictions(
+                            key.pop('max_predictions', settings.DEFAULT_MAX_PREDICTIONS))
+                    except ValueError as e:
+                        ws.send_json(dict(error=400, message=str(e)))
+                        continue
+                    product_exists = await CATALOG.is_available(**key)
                     if not product_exists:
                         ws.send_json(dict(error=404, message='No such key'))
-                    pathway_coll = PathwayCollection(key, mongo_client=MONGO_CLIENT)
-                    document = pathway_coll.find()
+                    pathway_coll = AsyncPathwayCollection(key, mongo_client=MONGO_CLIENT)
+                    document = await pathway_coll.find()
                     pathways_in_db = []
                     is_ready = False
                     if document:
-                        pathways_in_db = document['pathways']
-                        is_ready = document['ready']
+                        pathways_in_db = document['pathways'][:max_predictions]
+                        is_ready = bool(prediction_is_ready(document, max_predictions))
                     ws.send_json(
                         dict(pathways=pathways_in_db, is_ready=is_ready))
             elif msg.type == WSMsgType.ERROR:
@@ -241,6 +183,13 @@ app.router.add_route('GET', '/pathways/lists/universal_model', universal_model_l
 app.router.add_route('GET', '/pathways/lists/carbon_source', carbon_source_list)
 
 
+async def shutdown_job_runner(app):
+    JOB_RUNNER.shutdown(wait=False)
+
+
+app.on_shutdown.append(shutdown_job_runner)
+
+
 # Configure default CORS settings.
 cors = aiohttp_cors.setup(app, defaults={
     "*": aiohttp_cors.ResourceOptions(
@@ -261,8 +210,8 @@ async def start(loop):
 
 if __name__ == '__main__':
     # Put the most used predictor to memory
-    get_predictor('iJO1366', 'metanetx_universal_model_bigg')
     loop = asyncio.get_event_loop()
+    JOB_RUNNER.warm_up('iJO1366', 'metanetx_universal_model_bigg')
     loop.run_until_complete(start(loop))
     try:
         loop.run_forever()
@@ -0,0 +1,121 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import gzip
+import json
+import logging
+import time
+from collections import namedtuple
+
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+JSONBody = namedtuple('JSONBody', ['json', 'gzipped'])
+
+
+def json_body(data):
+    """Serialize and compress a response body once, so it can be served many times"""
+    body = json.dumps(data).encode('utf-8')
+    return JSONBody(body, gzip.compress(body))
+
+
+def list_body(documents):
+    return json_body([{'id': d['_id'], 'name': d['name']} for d in documents])
+
+
+class CatalogIndex(object):
+    """
+    In-memory index of the `lists.*` collections (universal models, models, carbon sources and products).
+
+    Availability checks and the list endpoints are answered from hash maps and pre-serialized bodies. The
+    collections only change when `tools/fill_lists.py` runs, which bumps the lists version stamp; the stamp is
+    checked at most every `check_interval` seconds, and the index is reloaded when it changes or when it is older
+    than `ttl` seconds.
+    """
+
+    def __init__(self, mongodb, ttl=None, check_interval=None):
+        self.mongodb = mongodb
+        self.ttl = ttl or settings.CATALOG_TTL
+        self.check_interval = check_interval or settings.CATALOG_CHECK_INTERVAL
+        self.universal_models = {}
+        self.models = {}
+        self.carbon_sources = {}
+        self.products = {}
+        self.bodies = {}
+        self.product_bodies = {}
+        self._empty_body = json_body([])
+        self._version = None
+        self._loaded_at = None
+        self._checked_at = None
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self):
+        return self._checked_at is not None and time.monotonic() - self._checked_at < self.check_interval
+
+    async def refresh(self, force=False):
+        if not force and self._is_fresh():
+            return
+        async with self._lock:
+            if not force and self._is_fresh():
+                return
+            version = await self.mongodb.lists_version()
+            expired = self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl
+            if force or expired or version != self._version:
+                await self._load(version)
+            self._checked_at = time.monotonic()
+
+    async def _load(self, version):
+        t = time.time()
+        universal_models = await self.mongodb.universal_models.find().to_list(None)
+        models = await self.mongodb.models.find().to_list(None)
+        carbon_sources = await self.mongodb.carbon_sources.find().to_list(None)
+        products = await self.mongodb.products.find().to_list(None)
+        self.universal_models = {d['_id']: d for d in universal_models}
+        self.models = {d['_id']: d for d in models}
+        self.carbon_sources = {d['_id']: d for d in carbon_sources}
+        self.products = {d['_id']: frozenset(d.get('universal_models', ())) for d in products}
+        self.bodies = {
+            'universal_model': list_body(universal_models),
+            'model': list_body(models),
+            'carbon_source': list_body(carbon_sources),
+        }
+        products_by_universal_model = {}
+        for product in products:
+            for universal_model_id in product.get('universal_models', ()):
+                products_by_universal_model.setdefault(universal_model_id, []).append(product)
+        self.product_bodies = {k: list_body(v) for k, v in products_by_universal_model.items()}
+        self._version = version
+        self._loaded_at = time.monotonic()
+        logger.debug("Loaded catalog (version {}) in {:.2f}s".format(version, time.time() - t))
+
+    async def is_available(self, model_id, universal_model_id, carbon_source_id, product_id):
+        await self.refresh()
+        return (
+            universal_model_id in self.universal_models and
+            (model_id == universal_model_id or model_id in self.models) and
+            carbon_source_id in self.carbon_sources and
+            universal_model_id in self.products.get(product_id, ())
+        )
+
+    async def list_body(self, name):
+        await self.refresh()
+        return self.bodies[name]
+
+    async def product_list_body(self, universal_model_id):
+        await self.refresh()
+        return self.product_bodies.get(universal_model_id, self._empty_body)
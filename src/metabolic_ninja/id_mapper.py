@@ -0,0 +1,128 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+
+import aiohttp
+
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_snapshot(path):
+    """Load a local MNX -> BiGG mapping table, stored as the `ids` object of an ID mapper response"""
+    with open(path) as f:
+        snapshot = json.load(f)
+    logger.debug("Loaded {} metabolite mappings from {}".format(len(snapshot), path))
+    return snapshot
+
+
+class IdMapper(object):
+    """
+    MNX -> BiGG metabolite ID mapping through the ID mapper API.
+
+    Mappings are looked up in the local snapshot table first, then in an in-process LRU cache (unmapped IDs are
+    cached too), and only the remaining IDs are queried, in a single batch over a kept-alive connection.
+    Concurrent lookups of the same IDs on the mapper's loop share one request; note that the prediction jobs look
+    up one pathway at a time (see `metabolic_ninja.prediction.bigg_ids`), so there they only benefit from the
+    snapshot, the cache and connection reuse.
+    """
+
+    def __init__(self, api=None, cache_size=None, snapshot_path=None, connection_limit=None, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.api = api or settings.ID_MAPPER_API
+        if not self.api:
+            raise KeyError("ID_MAPPER_API is not set")
+        self.cache_size = cache_size or settings.ID_MAPPING_CACHE_SIZE
+        snapshot_path = snapshot_path or settings.ID_MAPPING_SNAPSHOT
+        self.snapshot = load_snapshot(snapshot_path) if snapshot_path else {}
+        self.connection_limit = connection_limit or settings.ID_MAPPER_CONNECTIONS
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit, loop=self.loop)
+            self._session = aiohttp.ClientSession(connector=connector, loop=self.loop)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def bigg_ids(self, object_ids):
+        """Return a dict mapping each of the given MNX IDs which has a BiGG counterpart to a list of BiGG IDs"""
+        result = {}
+        missing = []
+        waiting = {}
+        for object_id in OrderedDict.fromkeys(object_ids):
+            if object_id in self.snapshot:
+                result[object_id] = self.snapshot[object_id]
+            elif object_id in self._cache:
+                self._cache.move_to_end(object_id)
+                if self._cache[object_id] is not None:
+                    result[object_id] = self._cache[object_id]
+            elif object_id in self._pending:
+                waiting[object_id] = self._pending[object_id]
+            else:
+                missing.append(object_id)
+        if missing:
+            result.update(await self._fetch(missing))
+        for object_id, future in waiting.items():
+            mapped = await asyncio.shield(future)
+            if object_id in mapped:
+                result[object_id] = mapped[object_id]
+        return result
+
+    async def _fetch(self, object_ids):
+        future = self.loop.create_future()
+        for object_id in object_ids:
+            self._pending[object_id] = future
+        try:
+            mapped = await self._query(object_ids)
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved; the caller re-raises it, other waiters get it from the future
+            future.exception()
+            raise
+        else:
+            future.set_result(mapped)
+            for object_id in object_ids:
+                self._remember(object_id, mapped.get(object_id))
+            return mapped
+        finally:
+            for object_id in object_ids:
+                self._pending.pop(object_id, None)
+
+    async def _query(self, object_ids):
+        logger.debug("Querying ID mapper for {} metabolites".format(len(object_ids)))
+        query = json.dumps({'ids': object_ids, 'dbFrom': 'mnx', 'dbTo': 'bigg', 'type': 'Metabolite'})
+        async with self.session.post(self.api, data=query) as response:
+            if response.status != 200:
+                raise IOError("ID mapper responded with status {}".format(response.status))
+            return (await response.json())['ids']
+
+    def _remember(self, object_id, bigg_ids):
+        self._cache[object_id] = bigg_ids
+        self._cache.move_to_end(object_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
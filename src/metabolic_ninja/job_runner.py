@@ -0,0 +1,181 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import multiprocessing
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import aiozmq.rpc
+
+from metabolic_ninja.prediction import predict_pathways, warm_up
+from . import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_job_runner():
+    """Use the node's predictor servers if there are any, otherwise a process pool of this worker"""
+    if settings.PREDICTOR_SERVERS:
+        return RemoteJobRunner()
+    return JobRunner()
+
+
+def _job_done(key, task):
+    if task.cancelled():
+        logger.warning("Prediction job was cancelled: {}".format(key))
+    elif task.exception() is not None:
+        logger.error("Prediction job failed: {}: {}".format(key, task.exception()))
+    else:
+        logger.info("Prediction job finished: {}".format(key))
+
+
+async def keep_lease(mongo_client, owner, task):
+    """
+    Extend the prediction lease of `owner` until the job's `task` is done. The lease is taken when the job is
+    submitted, but the job only renews it by itself once it has started, which may be long after the lease would
+    have expired if the job had to wait for a worker. If the task fails without the job giving up the lease, e.g.
+    because its process died, the lease is released so that the next request restarts the prediction right away.
+    """
+    while not task.done():
+        await asyncio.wait([task], timeout=settings.LEASE_HEARTBEAT_INTERVAL.total_seconds())
+        if task.done():
+            break
+        try:
+            if not await mongo_client.heartbeat(owner, settings.LEASE_TTL):
+                logger.warning("Prediction lease was lost: {}".format(mongo_client.key))
+                return
+        except Exception:
+            # A missed heartbeat is not fatal as long as the next one lands before the lease expires
+            logger.exception("Heartbeat failed: {}".format(mongo_client.key))
+    if task.cancelled() or task.exception() is not None:
+        try:
+            await mongo_client.release(owner)
+        except Exception:
+            logger.exception("Could not release the prediction lease: {}".format(mongo_client.key))
+
+
+def _track(task, mongo_client, owner):
+    task.add_done_callback(partial(_job_done, mongo_client.key))
+    asyncio.ensure_future(keep_lease(mongo_client, owner, task))
+    return task
+
+
+class JobRunner(object):
+    """
+    Runs prediction jobs in a bounded pool of worker processes, so the event loop only submits and awaits them.
+    Every worker process keeps its own predictor cache, which stays warm between jobs.
+
+    The pool's processes are started by a fork server rather than forked from this worker, which already runs the
+    Mongo client's background threads; a thread holding a lock at fork time would leave the child deadlocked.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or settings.PREDICTION_WORKERS
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            logger.debug("Starting prediction pool with {} workers".format(self.max_workers))
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['metabolic_ninja.prediction'])
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        return self._executor
+
+    async def run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self.executor, func, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OOM killer); start a fresh pool for the following jobs
+            logger.error("Prediction pool is broken; restarting it")
+            self.shutdown(wait=False)
+            raise
+
+    def submit(self, mongo_client, owner):
+        """
+        Schedule a prediction job for the key of `mongo_client`, an `AsyncPathwayCollection`, leased by `owner`, and
+        return the task awaiting it
+        """
+        task = asyncio.ensure_future(self.run(predict_pathways, mongo_client.key, owner))
+        return _track(task, mongo_client, owner)
+
+    def warm_up(self, model_id, universal_model_id):
+        """Submit one warm-up job per worker so that the given predictor is loaded before the first request"""
+        return [asyncio.ensure_future(self.run(warm_up, model_id, universal_model_id))
+                for _ in range(self.max_workers)]
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+class RemoteJobRunner(object):
+    """
+    Submits prediction jobs to the predictor servers of the node, see `metabolic_ninja.predictor_server`.
+    Jobs are routed by model pair, so that every pair is loaded by a single server.
+    """
+
+    def __init__(self, addresses=None):
+        self.addresses = addresses or settings.PREDICTOR_SERVERS
+        self._clients = {}
+
+    def address(self, model_id, universal_model_id):
+        pair = '{}/{}'.format(model_id, universal_model_id).encode('utf-8')
+        return self.addresses[zlib.crc32(pair) % len(self.addresses)]
+
+    async def client(self, address):
+        if address not in self._clients:
+            self._clients[address] = asyncio.ensure_future(aiozmq.rpc.connect_rpc(connect=address))
+        try:
+            return await asyncio.shield(self._clients[address])
+        except Exception:
+            self._clients.pop(address, None)
+            raise
+
+    async def run(self, method, model_id, universal_model_id, *args):
+        """
+        Call `method` on the server hosting the given pair. A server that does not answer a ping within
+        PREDICTOR_SERVER_PING_TIMEOUT, e.g. while it is being restarted, fails the call right away instead of
+        leaving it queued on the socket; the call itself is bounded by PREDICTION_TIMEOUT.
+        """
+        client = await self.client(self.address(model_id, universal_model_id))
+        await client.with_timeout(settings.PREDICTOR_SERVER_PING_TIMEOUT).call.ping()
+        return await getattr(client.with_timeout(settings.PREDICTION_TIMEOUT).call, method)(*args)
+
+    def submit(self, mongo_client, owner):
+        """
+        Schedule a prediction job for the key of `mongo_client`, an `AsyncPathwayCollection`, leased by `owner`, and
+        return the task awaiting it
+        """
+        key = mongo_client.key
+        task = asyncio.ensure_future(self.run('predict', key['model_id'], key['universal_model_id'], key, owner))
+        return _track(task, mongo_client, owner)
+
+    def warm_up(self, model_id, universal_model_id):
+        """Ask the server hosting the given predictor to load it"""
+        return [asyncio.ensure_future(self.run('warm_up', model_id, universal_model_id,
+                                               model_id, universal_model_id))]
+
+    def shutdown(self, wait=True):
+        for client in self._clients.values():
+            if client.done() and not client.cancelled() and client.exception() is None:
+                client.result().close()
+        self._clients = {}
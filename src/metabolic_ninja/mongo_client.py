@@ -15,7 +15,9 @@
 import os
 import logging
 from datetime import datetime
-from pymongo import MongoClient, ASCENDING
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from . import settings
 
@@ -37,6 +39,7 @@ class MongoDB(object):
         self.models = self.mongo_client.lists.model
         self.carbon_sources = self.mongo_client.lists.carbon_source
         self.products = self.mongo_client.lists.product
+        self.versions = self.mongo_client.lists.version
 
     @staticmethod
     def _insert_all(list, elements):
@@ -59,6 +62,14 @@ class MongoDB(object):
     def insert_carbon_sources_list(self, carbon_sources):
         self._insert_all(self.carbon_sources, carbon_sources)
 
+    def bump_lists_version(self):
+        """Mark the lists as changed, so that workers reload their catalog index"""
+        self.versions.update(
+            {'_id': 'lists'},
+            {'$set': {'stamp': datetime.now()}},
+            upsert=True
+        )
+
     def is_available(self, model_id, universal_model_id, carbon_source_id, product_id):
         return (
             self.universal_models.find_one(universal_model_id) and
@@ -68,37 +79,33 @@ class MongoDB(object):
         )
 
 
+class LeaseLost(Exception):
+    """The prediction lease of a key has expired or been taken over by another job"""
+
+
 class PathwayCollection(MongoDB):
     """
     Pymongo methods wrapper for simpler calls to model specific databases, defined by model, universal model,
-    carbon source and product
+    carbon source and product. If `owner` is given, writes only apply while that owner holds the prediction lease
+    of the key.
     """
-    def __init__(self, key, **kwargs):
+    def __init__(self, key, owner=None, **kwargs):
         super(PathwayCollection, self).__init__(**kwargs)
         self.key = key
+        self.owner = owner
         self.pathways = self.mongo_client.pathways.pathways
         for k, v in self.key.items():
             setattr(self, k, v)
-        # self.pathways.create_index([(k, ASCENDING) for k in self.key])
 
-    def upsert(self):
-        timestamp = datetime.now()
-        data = {
-            "pathways": [],
-            "ready": False,
-            "created": timestamp,
-            "updated": timestamp,
-        }
-        data.update(self.key)
-        self.pathways.update(
-            self.key,
-            {'$set': data},
-            upsert=True
-        )
+    @property
+    def owned_key(self):
+        if self.owner is None:
+            return self.key
+        return dict(self.key, **{'lease.owner': self.owner})
 
     def append_pathway(self, reactions_list, model, primary_nodes):
-        self.pathways.update(
-            self.key,
+        result = self.pathways.update_one(
+            self.owned_key,
             {
                 "$push": {
                     "pathways": {'reactions': reactions_list, 'model': model, 'primary_nodes': primary_nodes}
@@ -108,18 +115,221 @@ class PathwayCollection(MongoDB):
                 }
             }
         )
+        if not result.matched_count:
+            raise LeaseLost(self.key)
 
-    def set_ready(self):
-        self.pathways.update(
-            self.key,
+    def heartbeat(self, ttl):
+        """Extend the lease of the owner; return False if it does not hold the lease anymore"""
+        timestamp = datetime.now()
+        result = self.pathways.update_one(
+            self.owned_key,
+            {'$set': {
+                "lease.expires": timestamp + ttl,
+                "updated": timestamp,
+            }}
+        )
+        return bool(result.matched_count)
+
+    def set_ready(self, max_predictions):
+        """
+        Mark the prediction as complete for a target of `max_predictions` pathways and give up the lease. Return
+        False, keeping the lease, if the target has been raised in the meantime.
+        """
+        query = dict(self.owned_key, max_predictions={'$lte': max_predictions})
+        result = self.pathways.update_one(
+            query,
             {'$set': {
                 "ready": True,
+                "lease": None,
+                "updated": datetime.now(),
+            }}
+        )
+        return bool(result.matched_count)
+
+    def set_exhausted(self):
+        """Record that the predictor has no pathways left to find for the key"""
+        self.pathways.update(
+            self.owned_key,
+            {'$set': {
+                "exhausted": True,
+                "updated": datetime.now(),
+            }}
+        )
+
+    def restart(self):
+        """Drop the pathways found so far, so that the enumeration starts over"""
+        result = self.pathways.update_one(
+            self.owned_key,
+            {'$set': {
+                "pathways": [],
+                "exhausted": False,
+                "updated": datetime.now(),
+            }}
+        )
+        if not result.matched_count:
+            raise LeaseLost(self.key)
+
+    def release(self):
+        """Give up the lease, keeping the pathways found so far, so that the prediction can be resumed right away"""
+        self.pathways.update(
+            self.owned_key,
+            {'$set': {
+                "lease": None,
                 "updated": datetime.now(),
             }}
         )
 
     def remove(self):
-        self.pathways.remove(self.key)
+        self.pathways.remove(self.owned_key)
 
     def find(self):
         return self.pathways.find_one(self.key)
+
+
+class AsyncMongoDB(object):
+    """
+    Motor counterpart of `MongoDB` for use inside coroutines; every method returning data is awaitable
+    """
+
+    def __init__(self, mongo_client=None):
+        self.mongo_client = mongo_client or AsyncIOMotorClient(*MONGO_CRED)
+        self.universal_models = self.mongo_client.lists.universal_model
+        self.models = self.mongo_client.lists.model
+        self.carbon_sources = self.mongo_client.lists.carbon_source
+        self.products = self.mongo_client.lists.product
+        self.versions = self.mongo_client.lists.version
+
+    async def is_available(self, model_id, universal_model_id, carbon_source_id, product_id):
+        return (
+            await self.universal_models.find_one(universal_model_id) and
+            (model_id == universal_model_id or await self.models.find_one(model_id)) and
+            await self.carbon_sources.find_one(carbon_source_id) and
+            await self.products.find_one({"_id": product_id, 'universal_models': {'$in': [universal_model_id]}})
+        )
+
+    async def lists_version(self):
+        document = await self.versions.find_one('lists')
+        return document and document['stamp']
+
+
+class AsyncPathwayCollection(AsyncMongoDB):
+    """
+    Motor counterpart of `PathwayCollection`
+    """
+    _indexed = False
+
+    def __init__(self, key, **kwargs):
+        super(AsyncPathwayCollection, self).__init__(**kwargs)
+        self.key = key
+        self.pathways = self.mongo_client.pathways.pathways
+        for k, v in self.key.items():
+            setattr(self, k, v)
+
+    async def ensure_index(self):
+        """
+        Create the unique index on the key fields, which makes concurrent upserts of the same key resolve to a
+        single document. Keys stored twice before the index existed are deduplicated first; if the index can still
+        not be created, claims go on without it, at the risk of concurrent first claims of a key creating two
+        documents.
+        """
+        if AsyncPathwayCollection._indexed:
+            return
+        index = [(k, ASCENDING) for k in sorted(self.key)]
+        try:
+            await self.pathways.create_index(index, unique=True)
+        except DuplicateKeyError:
+            logger.warning("Duplicate pathway documents found; removing them to create the unique index")
+            try:
+                await self.remove_duplicates()
+                await self.pathways.create_index(index, unique=True)
+            except Exception:
+                logger.exception("Could not create the unique index of pathways; going on without it")
+        AsyncPathwayCollection._indexed = True
+
+    async def remove_duplicates(self):
+        """Keep a single document per key, preferring ready ones with the most pathways, and delete the others"""
+        groups = await self.pathways.aggregate([
+            {'$group': {
+                '_id': {k: '$' + k for k in self.key},
+                'ids': {'$push': '$_id'},
+                'count': {'$sum': 1},
+            }},
+            {'$match': {'count': {'$gt': 1}}},
+        ]).to_list(None)
+        for group in groups:
+            documents = await self.pathways.find({'_id': {'$in': group['ids']}}).to_list(None)
+            documents.sort(key=lambda d: (bool(d.get('ready')), len(d.get('pathways', []))), reverse=True)
+            duplicates = [document['_id'] for document in documents[1:]]
+            logger.info("Removing {} duplicate documents of {}".format(len(duplicates), group['_id']))
+            await self.pathways.delete_many({'_id': {'$in': duplicates}})
+
+    async def claim(self, owner, ttl, max_predictions):
+        """
+        Raise the key's target to `max_predictions` pathways and atomically take its prediction lease for `owner`,
+        creating the key's document if needed. The lease is granted if fewer than `max_predictions` pathways are
+        stored, enumeration is not exhausted and nobody holds an unexpired lease on the key; a job that holds the
+        lease picks up the raised target by itself. Pathways stored by a previous owner are kept, so the new owner
+        continues the enumeration. Return the document as it was before the claim, or None if the lease was not
+        granted.
+        """
+        await self.ensure_index()
+        timestamp = datetime.now()
+        try:
+            await self.pathways.update_one(
+                self.key,
+                {
+                    '$setOnInsert': {
+                        "pathways": [],
+                        "ready": False,
+                        "exhausted": False,
+                        "lease": None,
+                        "created": timestamp,
+                        "updated": timestamp,
+                    },
+                    '$max': {
+                        "max_predictions": max_predictions,
+                    },
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Another worker inserted the document concurrently
+            await self.pathways.update_one(self.key, {'$max': {"max_predictions": max_predictions}})
+        query = dict(self.key)
+        query['pathways.{}'.format(max_predictions - 1)] = {'$exists': False}
+        query['exhausted'] = {'$ne': True}
+        query['$or'] = [{'lease': None}, {'lease.expires': {'$lt': timestamp}}]
+        return await self.pathways.find_one_and_update(
+            query,
+            {'$set': {
+                "ready": False,
+                "lease": {'owner': owner, 'expires': timestamp + ttl},
+                "updated": timestamp,
+            }},
+            return_document=ReturnDocument.BEFORE
+        )
+
+    async def heartbeat(self, owner, ttl):
+        """Extend the lease of `owner`; return False if it does not hold the lease anymore"""
+        timestamp = datetime.now()
+        result = await self.pathways.update_one(
+            dict(self.key, **{'lease.owner': owner}),
+            {'$set': {
+                "lease.expires": timestamp + ttl,
+                "updated": timestamp,
+            }}
+        )
+        return bool(result.matched_count)
+
+    async def release(self, owner):
+        """Give up the lease of `owner`, if it still holds it"""
+        await self.pathways.update_one(
+            dict(self.key, **{'lease.owner': owner}),
+            {'$set': {
+                "lease": None,
+                "updated": datetime.now(),
+            }}
+        )
+
+    async def find(self):
+        return await self.pathways.find_one(self.key)
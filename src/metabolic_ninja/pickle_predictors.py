@@ -13,10 +13,21 @@
 # limitations under the License.
 
 import os
+import argparse
+import fcntl
+import hashlib
+import importlib
+import itertools
+import json
 import pickle
 import logging
+import sys
 import time
-from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache, partial
+import cameo
+import cobra
+import optlang
 from cameo import load_model, models
 from cameo.strain_design.pathway_prediction import PathwayPredictor
 
@@ -27,29 +38,223 @@ logger.setLevel(logging.DEBUG)
 
 
 PICKLED_PREDICTOR_PATH = 'pickles/cache_{}_{}.pickle'
+SNAPSHOT_PATH = 'pickles/snapshot_{}_{}'
+SNAPSHOT_FORMAT = 1
+SOLVER_MODULES = ['cplex', 'gurobipy', 'swiglpk']
+
+LOAD_METRICS = {}
+
+
+def environment_versions():
+    """Versions of everything a snapshot depends on; a snapshot made with different versions is rebuilt"""
+    versions = {
+        'format': SNAPSHOT_FORMAT,
+        'cameo': cameo.__version__,
+        'cobra': cobra.__version__,
+        'optlang': optlang.__version__,
+    }
+    for name in SOLVER_MODULES:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+        versions[name] = str(getattr(module, '__version__', 'unknown'))
+    return versions
+
+
+def record_load_metrics(model_id, universal_model_id, format, seconds, size):
+    LOAD_METRICS[(model_id, universal_model_id)] = {'format': format, 'seconds': seconds, 'bytes': size}
+    logger.info("{}/{}: loaded {} ({:.1f} MB) in {:.2f}s; {}".format(
+        model_id, universal_model_id, format, size / 2**20, seconds, load_summary()))
+
+
+def load_summary():
+    """One line summary of LOAD_METRICS, i.e. of every predictor loaded by this process"""
+    totals = {}
+    for metrics in LOAD_METRICS.values():
+        count, seconds, size = totals.get(metrics['format'], (0, 0., 0))
+        totals[metrics['format']] = count + 1, seconds + metrics['seconds'], size + metrics['bytes']
+    return "process {} has loaded {}".format(os.getpid(), ", ".join(
+        "{} {} ({:.1f} MB) in {:.2f}s".format(count, format, size / 2**20, seconds)
+        for format, (count, seconds, size) in sorted(totals.items())))
+
+
+def atomic_write(path, write):
+    """Call `write` with a temporary file object and rename the file to `path` once it is complete"""
+    tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class PredictorSnapshot(object):
+    """
+    Versioned on-disk snapshot of a predictor, stored as a directory holding:
+
+    - `header.json`: format and library/solver versions, the sha256 of the payload and the names of the files below
+    - `predictor-<sha256>.pickle`: the pickled predictor
+    - `solver-<sha256>.prm`: the tuned solver parameters, which do not survive pickling of the solver problem
+
+    Every file is written to a temporary file and renamed into place, and the header goes last, so readers never
+    see a half-written snapshot. The header is a separate file so that freshness can be checked without reading
+    the payload; the payload is read, checked against the header and unpickled when `predictor` is accessed.
+
+    Dumps of the same snapshot are serialized by a lock file. A dump keeps the files of the generation it replaces,
+    for readers that read the previous header just before; a reader whose payload is gone nonetheless, because
+    it was two generations behind, re-reads the header and loads the current generation.
+    """
+    HEADER = 'header.json'
+    LOCK = 'dump.lock'
+    PAYLOAD = 'predictor-{}.pickle'
+    SOLVER_PARAMETERS = 'solver-{}.prm'
+
+    def __init__(self, model_id, universal_model_id, path=None):
+        self.model_id = model_id
+        self.universal_model_id = universal_model_id
+        self.path = path or SNAPSHOT_PATH.format(model_id, universal_model_id)
+        self._header = None
+        self._predictor = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _read_header(self):
+        try:
+            with open(self._file(self.HEADER)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = self._read_header()
+        return self._header
+
+    def is_fresh(self):
+        return self.header is not None and self.header['versions'] == environment_versions()
+
+    @property
+    def size(self):
+        return os.path.getsize(self._file(self.header['payload']))
+
+    @property
+    def predictor(self):
+        if self._predictor is None:
+            self._predictor = self._load()
+        return self._predictor
+
+    def _load(self):
+        try:
+            return self._read_payload()
+        except FileNotFoundError:
+            self._header = None
+            if not self.is_fresh():
+                raise
+            logger.debug("{}/{}: snapshot was replaced while loading; loading the current one".format(
+                self.model_id, self.universal_model_id))
+            return self._read_payload()
+
+    def _read_payload(self):
+        t = time.time()
+        with open(self._file(self.header['payload']), 'rb') as f:
+            payload = f.read()
+        if hashlib.sha256(payload).hexdigest() != self.header['sha256']:
+            raise ValueError("{}: payload does not match the header checksum".format(self.path))
+        predictor = pickle.loads(payload)
+        size = len(payload)
+        if self.header['solver_parameters']:
+            predictor.model.solver.problem.parameters.read_file(self._file(self.header['solver_parameters']))
+        record_load_metrics(self.model_id, self.universal_model_id, 'snapshot', time.time() - t, size)
+        return predictor
+
+    def dump(self, predictor):
+        t = time.time()
+        os.makedirs(self.path, exist_ok=True)
+        payload = pickle.dumps(predictor, protocol=pickle.HIGHEST_PROTOCOL)
+        sha256 = hashlib.sha256(payload).hexdigest()
+        with open(self._file(self.LOCK), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            previous_header = self._read_header()
+            payload_name = self.PAYLOAD.format(sha256)
+            atomic_write(self._file(payload_name), lambda f: f.write(payload))
+            solver_parameters_name = None
+            parameters = getattr(predictor.model.solver.problem, 'parameters', None)
+            if hasattr(parameters, 'write_file'):
+                solver_parameters_name = self.SOLVER_PARAMETERS.format(sha256)
+                tmp_path = '{}.tmp.{}'.format(self._file(solver_parameters_name), os.getpid())
+                parameters.write_file(tmp_path)
+                os.replace(tmp_path, self._file(solver_parameters_name))
+            header = {
+                'model_id': self.model_id,
+                'universal_model_id': self.universal_model_id,
+                'versions': environment_versions(),
+                'sha256': sha256,
+                'payload': payload_name,
+                'solver_parameters': solver_parameters_name,
+                'created': time.time(),
+            }
+            atomic_write(self._file(self.HEADER), lambda f: f.write(json.dumps(header, indent=2).encode('utf-8')))
+            self._header = header
+            self._predictor = predictor
+            self._remove_stale_files(previous_header)
+        logger.debug("{}/{}: dumped snapshot in {:.2f}s".format(
+            self.model_id, self.universal_model_id, time.time() - t))
+
+    def _remove_stale_files(self, previous_header):
+        """Remove the files of every generation but the current and the previous one; the dump lock must be held"""
+        keep = {self.HEADER, self.LOCK}
+        for header in (self.header, previous_header):
+            if header is not None:
+                keep.update({header['payload'], header['solver_parameters']})
+        for name in os.listdir(self.path):
+            if name not in keep and '.tmp.' not in name:
+                os.remove(self._file(name))
 
 
 @lru_cache(2**6)
 def get_predictor(model_id, universal_model_id):
-    if os.path.exists(PICKLED_PREDICTOR_PATH.format(model_id, universal_model_id)):
-        logger.debug("{}/{}: cached model found, loading from disk".format(model_id, universal_model_id))
-        predictor = load_predictor(model_id, universal_model_id)
+    snapshot = PredictorSnapshot(model_id, universal_model_id)
+    predictor = None
+    if snapshot.is_fresh():
+        logger.debug("{}/{}: snapshot found, loading from disk".format(model_id, universal_model_id))
+        try:
+            predictor = snapshot.predictor
+        except Exception as e:
+            logger.warning("{}/{}: snapshot is broken ({}); rebuilding".format(model_id, universal_model_id, e))
+    elif snapshot.header is not None:
+        logger.info("{}/{}: snapshot was made with {}; rebuilding".format(
+            model_id, universal_model_id, snapshot.header['versions']))
     else:
-        logger.debug("{}/{}: no cached model found; generating and dumping".format(model_id, universal_model_id))
+        logger.debug("{}/{}: no snapshot found; generating and dumping".format(model_id, universal_model_id))
+    if predictor is None:
         predictor = generate_predictor(model_id, universal_model_id)
-        dump_predictor(predictor, model_id, universal_model_id)
+        snapshot.dump(predictor)
     logger.debug("{}/{}: predictor is ready".format(model_id, universal_model_id))
     return predictor
 
 
 def load_predictor(model_id, universal_model_id):
+    """Load a legacy, unversioned pickle; kept to compare load times against snapshots, see `compare_load`"""
     t = time.time()
-    with open(PICKLED_PREDICTOR_PATH.format(model_id, universal_model_id), 'rb') as f:
+    path = PICKLED_PREDICTOR_PATH.format(model_id, universal_model_id)
+    with open(path, 'rb') as f:
         p = pickle.load(f)
-    logger.debug("{}/{}: unpickled in {:.2f}s".format(model_id, universal_model_id, time.time() - t))
+    record_load_metrics(model_id, universal_model_id, 'pickle', time.time() - t, os.path.getsize(path))
     return p
 
 
+def dump_legacy_predictor(predictor, model_id, universal_model_id):
+    path = PICKLED_PREDICTOR_PATH.format(model_id, universal_model_id)
+    atomic_write(path, lambda f: pickle.dump(predictor, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+
 def generate_predictor(model_id, universal_model_id):
     t = time.time()
     universal_model = getattr(models.universal, universal_model_id)
@@ -64,11 +269,7 @@ def generate_predictor(model_id, universal_model_id):
 
 
 def dump_predictor(predictor, model_id, universal_model_id):
-    t = time.time()
-    with open(PICKLED_PREDICTOR_PATH.format(model_id, universal_model_id), 'wb') as f:
-        logger.debug("{}/{}: dumping pickle".format(model_id, universal_model_id))
-        pickle.dump(predictor, f)
-    logger.debug("{}/{}: dumped predictor in {:.2f}s".format(model_id, universal_model_id, time.time() - t))
+    PredictorSnapshot(model_id, universal_model_id).dump(predictor)
 
 
 MODELS_IDS = ['iJO1366', 'iMM904']
@@ -81,7 +282,84 @@ UNIVERSAL_MODELS_IDS = [
 ]
 
 
+def build_snapshot(model_id, universal_model_id, force=False):
+    """Build the snapshot of a model pair unless it is fresh; return a report row"""
+    t = time.time()
+    snapshot = PredictorSnapshot(model_id, universal_model_id)
+    if snapshot.is_fresh() and not force:
+        status = 'fresh'
+    else:
+        snapshot.dump(generate_predictor(model_id, universal_model_id))
+        status = 'built'
+    return {
+        'model_id': model_id,
+        'universal_model_id': universal_model_id,
+        'status': status,
+        'seconds': time.time() - t,
+        'bytes': snapshot.size,
+    }
+
+
+def compare_load(model_id, universal_model_id):
+    """
+    Time loading the snapshot of a model pair against loading the legacy pickle of the same predictor, which is
+    written from the snapshot if it does not exist; return a report row. Meant to run in a fresh process.
+    """
+    snapshot = PredictorSnapshot(model_id, universal_model_id)
+    if not snapshot.is_fresh():
+        raise ValueError("{}/{}: no fresh snapshot; build it first".format(model_id, universal_model_id))
+    predictor = snapshot.predictor
+    if not os.path.exists(PICKLED_PREDICTOR_PATH.format(model_id, universal_model_id)):
+        dump_legacy_predictor(predictor, model_id, universal_model_id)
+    snapshot_metrics = LOAD_METRICS[(model_id, universal_model_id)]
+    del predictor, snapshot
+    load_predictor(model_id, universal_model_id)
+    pickle_metrics = LOAD_METRICS[(model_id, universal_model_id)]
+    return {
+        'model_id': model_id,
+        'universal_model_id': universal_model_id,
+        'snapshot_seconds': snapshot_metrics['seconds'],
+        'pickle_seconds': pickle_metrics['seconds'],
+        'bytes': snapshot_metrics['bytes'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build predictor snapshots for every model and universal model pair.")
+    parser.add_argument('--models', nargs='+', default=MODELS_IDS)
+    parser.add_argument('--universal-models', nargs='+', default=UNIVERSAL_MODELS_IDS)
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="pairs built in parallel; every build holds a full predictor in memory")
+    parser.add_argument('--force', action='store_true', help="rebuild fresh snapshots too")
+    parser.add_argument('--compare-pickle', action='store_true',
+                        help="instead of building, time loading every snapshot against loading a legacy pickle")
+    args = parser.parse_args()
+    pairs = list(itertools.product(args.models, args.universal_models))
+    if args.compare_pickle:
+        columns, job = ('snapshot s', 'pickle s', 'MB'), compare_load
+        row_format = "{model_id:<12} {universal_model_id:<50} {snapshot_seconds:>10.2f} {pickle_seconds:>10.2f} " \
+                     "{megabytes:>10.1f}"
+    else:
+        columns, job = ('status', 'seconds', 'MB'), partial(build_snapshot, force=args.force)
+        row_format = "{model_id:<12} {universal_model_id:<50} {status:>10} {seconds:>10.2f} {megabytes:>10.1f}"
+    t = time.time()
+    failed = False
+    with ProcessPoolExecutor(max_workers=min(args.processes, len(pairs))) as executor:
+        futures = {executor.submit(job, m, u): (m, u) for m, u in pairs}
+        print("{:<12} {:<50} {:>10} {:>10} {:>10}".format('model', 'universal model', *columns))
+        for future in as_completed(futures):
+            m, u = futures[future]
+            try:
+                row = future.result()
+            except Exception:
+                failed = True
+                logger.exception("{}/{}: failed".format(m, u))
+                print("{:<12} {:<50} {:>10} {:>10} {:>10}".format(m, u, 'failed', '-', '-'))
+            else:
+                print(row_format.format(megabytes=row['bytes'] / 2**20, **row))
+    print("{} pairs in {:.2f}s".format(len(pairs), time.time() - t))
+    sys.exit(1 if failed else 0)
+
+
 if __name__ == '__main__':
-    for m in MODELS_IDS:
-        for u in UNIVERSAL_MODELS_IDS:
-            dump_predictor(get_predictor(m, u), m, u)
+    main()
@@ -0,0 +1,256 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import os
+import copy
+import threading
+import time
+import json
+from copy import deepcopy
+import cobra
+from pymongo import MongoClient
+from metabolic_ninja.id_mapper import IdMapper
+from metabolic_ninja.pathway_graph import PathwayGraph
+from metabolic_ninja.mongo_client import PathwayCollection, LeaseLost, MONGO_CRED
+from metabolic_ninja.pickle_predictors import get_predictor
+from . import raven_client, settings
+
+
+logger = logging.getLogger(__name__)
+
+_mongo_clients = {}
+
+_id_mappers = {}
+
+
+def get_mongo_client():
+    """MongoClient of the current process; clients must not be shared across fork()"""
+    pid = os.getpid()
+    if pid not in _mongo_clients:
+        _mongo_clients[pid] = MongoClient(*MONGO_CRED, maxPoolSize=None)
+    return _mongo_clients[pid]
+
+
+def get_id_mapper():
+    """IdMapper of the current process, running on its own event loop"""
+    pid = os.getpid()
+    if pid not in _id_mappers:
+        _id_mappers[pid] = IdMapper(loop=asyncio.new_event_loop())
+    return _id_mappers[pid]
+
+
+def pathway_to_model(pathway):
+    model = cobra.Model('test')
+    model.add_reactions(deepcopy(list(pathway.reactions)))
+    return json.loads(cobra.io.to_json(model))
+
+
+def pathway_to_list(pathway):
+    return [reaction_to_dict(reaction) for reaction in pathway.reactions]
+
+
+def reaction_to_dict(reaction):
+    return dict(
+        id=reaction.id,
+        name=reaction.name,
+        reaction_string=reaction.build_reaction_string(use_metabolite_names=True),
+    )
+
+
+def metabolite_to_dict(metabolite):
+    return dict(
+        id=metabolite.id,
+        name=metabolite.name,
+        formula=metabolite.formula,
+    )
+
+
+def bigg_ids(object_ids):
+    # Called from the predictor callback in a job process, one pathway at a time, so it is fine to block on the
+    # mapper's own loop; lookups are sequential here and never coalesced, the cache and snapshot do the work
+    id_mapper = get_id_mapper()
+    return id_mapper.loop.run_until_complete(id_mapper.bigg_ids(object_ids))
+
+
+def append_pathway(mongo_client, pathway):
+    logger.debug("Pathway is ready, adding to mongo: {}".format(mongo_client.key))
+    pathway = map_metabolites_ids_to_bigg(pathway)
+    pathway_graph = PathwayGraph(pathway, mongo_client.product_id)
+    reactions_list = [reaction_to_dict(reaction) for reaction in pathway_graph.sorted_reactions]
+    primary_nodes = [metabolite_to_dict(metabolite) for metabolite in pathway_graph.sorted_primary_nodes]
+    mongo_client.append_pathway(reactions_list, pathway_to_model(pathway), primary_nodes)
+
+
+def map_metabolites_ids_to_bigg(pathway_original):
+    pathway = copy.deepcopy(pathway_original)
+    all_met_ids = bigg_ids(
+        [met.id for reaction in pathway.reactions for met in
+         reaction.metabolites])
+    for reaction in pathway.reactions:
+        for metabolite in reaction.metabolites:
+            metabolite.id = all_met_ids[metabolite.id][0] + '_c' \
+                if metabolite.id in all_met_ids else metabolite.id
+    return pathway
+
+
+def warm_up(model_id, universal_model_id):
+    """Load the predictor into the cache of the current process"""
+    get_predictor(model_id, universal_model_id)
+
+
+class Heartbeat(threading.Thread):
+    """Keeps extending the prediction lease of a job while it is running"""
+
+    def __init__(self, mongo_client):
+        super(Heartbeat, self).__init__(daemon=True)
+        self.mongo_client = mongo_client
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(settings.LEASE_HEARTBEAT_INTERVAL.total_seconds()):
+            try:
+                if not self.mongo_client.heartbeat(settings.LEASE_TTL):
+                    logger.warning("Prediction lease was lost: {}".format(self.mongo_client.key))
+                    self.lost = True
+                    return
+            except Exception:
+                # A missed heartbeat is not fatal as long as the next one lands before the lease expires
+                logger.exception("Heartbeat failed: {}".format(self.mongo_client.key))
+
+    def stop(self):
+        self._stopped.set()
+
+
+def ensure_lease(mongo_client, heartbeat):
+    """Renew the job's lease, raising `LeaseLost` if it does not hold it anymore"""
+    if heartbeat.lost or not mongo_client.heartbeat(settings.LEASE_TTL):
+        raise LeaseLost(mongo_client.key)
+
+
+def append_pathway_while_leased(mongo_client, heartbeat, pathway):
+    if heartbeat.lost:
+        raise LeaseLost(mongo_client.key)
+    append_pathway(mongo_client, pathway)
+
+
+class NotResumable(Exception):
+    """Stored pathways cannot be excluded from the predictor, so the enumeration cannot continue after them"""
+
+
+def exclusion_cuts(predictor, pathways):
+    """
+    Integer cuts excluding the given stored pathways from the predictor's MILP; the same cuts
+    `PathwayPredictor.run` adds after every pathway it finds, so enumeration continues with the next pathway.
+    Raise `NotResumable` if a stored reaction has no switch variable in the predictor, e.g. because the universal
+    model has changed since the pathway was stored; a cut leaving it out would exclude other pathways as well.
+    """
+    cuts = []
+    for i, pathway in enumerate(pathways):
+        switches = []
+        for reaction in pathway['model']['reactions']:
+            try:
+                switches.append(predictor.model.solver.variables['y_' + reaction['id']])
+            except KeyError:
+                raise NotResumable("reaction {} of pathway {} is not in the predictor".format(reaction['id'], i))
+        if switches:
+            cuts.append(predictor.model.solver.interface.Constraint(
+                sum(switches[1:], switches[0]),
+                name='resume_cut_{}'.format(i),
+                ub=len(switches) - 1,
+            ))
+    return cuts
+
+
+def extend_enumeration(mongo_client, heartbeat, stored_pathways, max_predictions):
+    """
+    Continue the enumeration of the key's pathways after the stored ones until `max_predictions` pathways are
+    stored; return the number of pathways found
+    """
+    remaining = max_predictions - len(stored_pathways)
+    found = []
+
+    def callback(pathway):
+        append_pathway_while_leased(mongo_client, heartbeat, pathway)
+        found.append(pathway)
+
+    logger.debug("Getting predictor: {}".format(mongo_client.key))
+    predictor = get_predictor(mongo_client.model_id, mongo_client.universal_model_id)
+    # Loading the predictor may take minutes; do not start enumerating for a key that another job has taken over
+    ensure_lease(mongo_client, heartbeat)
+    cuts = exclusion_cuts(predictor, stored_pathways)
+    predictor.model.solver.add(cuts)
+    try:
+        logger.debug("Predicting pathways {}-{}: {}".format(
+            len(stored_pathways) + 1, max_predictions, mongo_client.key))
+        predictor.run(
+            product=mongo_client.product_id,
+            max_predictions=remaining,
+            callback=callback,
+        )
+    finally:
+        # The predictor is cached and reused by the following jobs of this process
+        predictor.model.solver.remove(cuts)
+    return len(found)
+
+
+def predict_pathways(key: dict, owner: str):
+    """
+    Run a prediction job for the given key, storing every found pathway in mongo until the key's target number
+    of pathways is reached. The job must hold the prediction lease of the key (see `AsyncPathwayCollection.claim`),
+    which the submitter keeps renewing until the job is done and the job itself renews while it is running; the
+    job checks it before loading the predictor and before enumerating, and stops as soon as it loses it.
+    Stored pathways, from a previous failed job or a smaller target, are excluded from the search, so the job only
+    computes the missing ones; if they cannot be excluded (see `exclusion_cuts`), they are dropped and the
+    enumeration starts over. A target raised while the job is running is picked up before it finishes.
+    Blocking and CPU-bound; meant to be executed in a worker process, see `metabolic_ninja.job_runner`.
+    """
+    t = time.time()
+    logger.info("Starting prediction job: {}".format(key))
+    mongo_client = PathwayCollection(key, owner=owner, mongo_client=get_mongo_client())
+    heartbeat = Heartbeat(mongo_client)
+    heartbeat.start()
+    try:
+        while True:
+            document = mongo_client.find()
+            if (document.get('lease') or {}).get('owner') != owner:
+                raise LeaseLost(key)
+            stored_pathways = document['pathways']
+            max_predictions = document.get('max_predictions', settings.DEFAULT_MAX_PREDICTIONS)
+            if len(stored_pathways) < max_predictions and not document.get('exhausted'):
+                try:
+                    found = extend_enumeration(mongo_client, heartbeat, stored_pathways, max_predictions)
+                except NotResumable as e:
+                    logger.warning("Cannot resume after the stored pathways, starting over ({}): {}".format(e, key))
+                    mongo_client.restart()
+                    continue
+                if found < max_predictions - len(stored_pathways):
+                    logger.debug("No pathways left after {}: {}".format(len(stored_pathways) + found, key))
+                    mongo_client.set_exhausted()
+            elif mongo_client.set_ready(max_predictions):
+                break
+    except LeaseLost:
+        logger.error("Prediction lease was lost; abandoning the job: {}".format(key))
+        raise
+    except Exception:
+        raven_client.captureException()
+        logger.error("Error during pathway prediction; releasing the lease to resume later: {}".format(key))
+        mongo_client.release()
+        raise
+    else:
+        logger.debug("Prediction complete in {:.2f}s: {}".format(time.time() - t, key))
+    finally:
+        heartbeat.stop()
@@ -0,0 +1,222 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Node-local predictor server.
+
+Predictors are loaded once per server and every prediction job runs in a child process forked from the process
+holding them. The children share the loaded models copy-on-write instead of each unpickling their own copy, and
+whatever a job does to its predictor (e.g. adding integer cuts) stays in the child. Web workers submit jobs over
+ZeroMQ RPC, see `metabolic_ninja.job_runner.RemoteJobRunner`.
+
+The RPC side runs ZeroMQ and asyncio machinery, so predictors are loaded and jobs are forked by a separate,
+single-threaded helper process (`run_forker`) which is started before any of it exists; forking from a process
+with other threads could leave the child with a lock held by a thread that does not exist in it. A supervisor
+(`--supervise`) restarts servers that die, e.g. when unpickling a universal model runs out of memory.
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import aiozmq.rpc
+
+from metabolic_ninja.pickle_predictors import get_predictor
+from metabolic_ninja.prediction import predict_pathways
+
+
+logger = logging.getLogger(__name__)
+
+SUPERVISE_INTERVAL = 1
+FORKER_POLL_INTERVAL = 0.5
+
+
+def run_forker(connection):
+    """
+    Main loop of the helper process. Requests are `(request_id, command, args)` tuples, answered with
+    `(request_id, error)` once the predictor is loaded (`load`) or the forked job has exited (`predict`), where
+    `error` is None on success.
+    """
+    jobs = {}
+    while True:
+        if connection.poll(FORKER_POLL_INTERVAL):
+            try:
+                request_id, command, args = connection.recv()
+            except EOFError:
+                # The server is gone
+                break
+            try:
+                if command == 'load':
+                    get_predictor(*args)
+                    connection.send((request_id, None))
+                elif command == 'predict':
+                    process = multiprocessing.get_context('fork').Process(target=predict_pathways, args=args)
+                    process.start()
+                    jobs[request_id] = process
+                else:
+                    raise ValueError("Unknown command {}".format(command))
+            except Exception as e:
+                logger.exception("Forker request {} failed".format(command))
+                connection.send((request_id, repr(e)))
+        for request_id, process in list(jobs.items()):
+            if process.exitcode is not None:
+                error = None if process.exitcode == 0 else "Prediction job exited with code {}".format(
+                    process.exitcode)
+                connection.send((request_id, error))
+                del jobs[request_id]
+
+
+def start_forker():
+    """
+    Start the helper process; must be called before the server starts any thread. It is not a daemon, since
+    daemonic processes cannot start the job processes, so the server terminates it on shutdown.
+    """
+    connection, forker_connection = multiprocessing.Pipe()
+    forker = multiprocessing.get_context('fork').Process(target=run_forker, args=(forker_connection,))
+    forker.start()
+    forker_connection.close()
+    return forker, connection
+
+
+class PredictorServer(aiozmq.rpc.AttrHandler):
+
+    def __init__(self, connection, max_jobs=None, loop=None):
+        self.connection = connection
+        self.max_jobs = max_jobs or os.cpu_count()
+        self.loop = loop or asyncio.get_event_loop()
+        self._jobs = asyncio.Semaphore(self.max_jobs)
+        self._predictors = {}
+        self._requests = {}
+        self._request_ids = itertools.count()
+        self.loop.add_reader(self.connection.fileno(), self._receive)
+
+    def _receive(self):
+        try:
+            while self.connection.poll():
+                request_id, error = self.connection.recv()
+                future = self._requests.pop(request_id)
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(RuntimeError(error))
+        except EOFError:
+            logger.error("Forker process is gone; stopping the server")
+            self.loop.remove_reader(self.connection.fileno())
+            self.loop.stop()
+
+    def _request(self, command, *args):
+        request_id = next(self._request_ids)
+        future = self.loop.create_future()
+        self._requests[request_id] = future
+        self.connection.send((request_id, command, args))
+        return future
+
+    async def _load(self, model_id, universal_model_id):
+        pair = (model_id, universal_model_id)
+        if pair not in self._predictors:
+            self._predictors[pair] = self._request('load', model_id, universal_model_id)
+        try:
+            await asyncio.shield(self._predictors[pair])
+        except Exception:
+            # Let the next job retry loading the predictor
+            self._predictors.pop(pair, None)
+            raise
+
+    @aiozmq.rpc.method
+    def ping(self):
+        return True
+
+    @aiozmq.rpc.method
+    async def warm_up(self, model_id, universal_model_id):
+        await self._load(model_id, universal_model_id)
+
+    @aiozmq.rpc.method
+    async def predict(self, key, owner):
+        await self._load(key['model_id'], key['universal_model_id'])
+        async with self._jobs:
+            logger.debug("Forking prediction job: {}".format(key))
+            await self._request('predict', key, owner)
+
+
+def supervise(args):
+    """Run one server per bind address, restarting the ones that exit"""
+    processes = {}
+    server_args = ['--max-jobs', str(args.max_jobs)] if args.max_jobs else []
+    if args.preload:
+        server_args += ['--preload'] + args.preload
+    # Turn SIGTERM (sent by gunicorn on exit) into SystemExit, so that the servers are terminated too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            for address in args.bind:
+                process = processes.get(address)
+                if process is not None and process.poll() is not None:
+                    logger.error("Predictor server on {} exited with code {}; restarting".format(
+                        address, process.returncode))
+                if process is None or process.poll() is not None:
+                    processes[address] = subprocess.Popen(
+                        [sys.executable, '-m', 'metabolic_ninja.predictor_server', '--bind', address] + server_args)
+            time.sleep(SUPERVISE_INTERVAL)
+    finally:
+        for process in processes.values():
+            process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Host pathway predictors for the web workers of this node.")
+    parser.add_argument('--bind', action='append', required=True,
+                        help="ZeroMQ endpoint, e.g. ipc:///tmp/predictor-0; repeat with --supervise")
+    parser.add_argument('--supervise', action='store_true',
+                        help="run and restart one server per --bind address")
+    parser.add_argument('--max-jobs', type=int, help="concurrent prediction jobs (default: number of CPUs)")
+    parser.add_argument('--preload', nargs='*', default=[], metavar='MODEL_ID/UNIVERSAL_MODEL_ID',
+                        help="predictors to load on startup")
+    args = parser.parse_args()
+    if args.supervise:
+        supervise(args)
+        return
+    if len(args.bind) != 1:
+        parser.error("a server binds to a single address; use --supervise to run several")
+    forker, connection = start_forker()
+    loop = asyncio.get_event_loop()
+    handler = PredictorServer(connection, max_jobs=args.max_jobs, loop=loop)
+    server = loop.run_until_complete(aiozmq.rpc.serve_rpc(handler, bind=args.bind[0]))
+    logger.info("Predictor server is up on {}".format(args.bind[0]))
+    for pair in args.preload:
+        loop.run_until_complete(handler.warm_up(*pair.split('/')))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        connection.close()
+        forker_died = not forker.is_alive()
+        # Running jobs are left to finish; they hold the lease of their key
+        forker.terminate()
+        forker.join()
+    # Exit with an error when the forker died, so that the supervisor restarts the server
+    if forker_died:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
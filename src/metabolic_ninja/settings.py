@@ -13,10 +13,25 @@
 # limitations under the License.
 
 import os
+from datetime import timedelta
 
 MONGO_ADDR = os.environ['MONGO_ADDR']
 MONGO_PORT = int(os.environ['MONGO_PORT'])
 SENTRY_DSN = os.environ.get('SENTRY_DSN', '')
+PREDICTION_WORKERS = int(os.environ.get('PREDICTION_WORKERS', 1))
+PREDICTOR_SERVERS = [address for address in os.environ.get('PREDICTOR_SERVERS', '').split(',') if address]
+PREDICTOR_SERVER_PING_TIMEOUT = int(os.environ.get('PREDICTOR_SERVER_PING_TIMEOUT', 5))
+PREDICTION_TIMEOUT = int(os.environ.get('PREDICTION_TIMEOUT', 4 * 60 * 60))
+ID_MAPPER_API = os.environ.get('ID_MAPPER_API')
+ID_MAPPING_SNAPSHOT = os.environ.get('ID_MAPPING_SNAPSHOT')
+ID_MAPPING_CACHE_SIZE = int(os.environ.get('ID_MAPPING_CACHE_SIZE', 2**16))
+ID_MAPPER_CONNECTIONS = int(os.environ.get('ID_MAPPER_CONNECTIONS', 4))
+CATALOG_TTL = int(os.environ.get('CATALOG_TTL', 3600))
+CATALOG_CHECK_INTERVAL = int(os.environ.get('CATALOG_CHECK_INTERVAL', 30))
+DEFAULT_MAX_PREDICTIONS = int(os.environ.get('DEFAULT_MAX_PREDICTIONS', 10))
+MAX_PREDICTIONS_LIMIT = int(os.environ.get('MAX_PREDICTIONS_LIMIT', 100))
+LEASE_TTL = timedelta(seconds=int(os.environ.get('LEASE_TTL', 30)))
+LEASE_HEARTBEAT_INTERVAL = timedelta(seconds=int(os.environ.get('LEASE_HEARTBEAT_INTERVAL', 10)))
 
 LOGGING = {
     'version': 1,
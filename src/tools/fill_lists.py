@@ -74,3 +74,4 @@ create_lists = [
 ]
 for f in create_lists:
     f()
+MongoDB().bump_lists_version()
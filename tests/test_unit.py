@@ -12,9 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import gzip
+import json
+import multiprocessing
+import os
 from collections import namedtuple
+from datetime import timedelta
+from types import SimpleNamespace
+import pytest
 from cobra.core import Reaction, Metabolite, Model
+from pymongo.errors import DuplicateKeyError
+from metabolic_ninja.app import parse_max_predictions, prediction_is_ready
+from metabolic_ninja.catalog import CatalogIndex
+from metabolic_ninja.id_mapper import IdMapper
+from metabolic_ninja.job_runner import RemoteJobRunner, keep_lease
+from metabolic_ninja.mongo_client import AsyncPathwayCollection, LeaseLost
 from metabolic_ninja.pathway_graph import PathwayGraph
+from metabolic_ninja import prediction
+from metabolic_ninja.prediction import NotResumable, exclusion_cuts
+from metabolic_ninja import pickle_predictors
+from metabolic_ninja.pickle_predictors import MODELS_IDS, UNIVERSAL_MODELS_IDS, LOAD_METRICS, PredictorSnapshot
+from metabolic_ninja import predictor_server
+from metabolic_ninja.predictor_server import PredictorServer
+from metabolic_ninja import settings
 
 
 Pathway = namedtuple('Pathway', ['reactions'])
@@ -39,3 +60,509 @@ def test_pathway_graph():
     pathway_line = Pathway([reaction1, reaction2])
     graph_line = PathwayGraph(pathway_line, 'C')
     assert names(graph_line.sorted_primary_nodes) == ['A', 'C']
+
+
+class StubIdMapper(IdMapper):
+    MAPPING = {'MNXM1671': ['itaccoa'], 'MNXM1747': ['itacon'], 'MNXM1251': ['citmcoa__L']}
+
+    def __init__(self, **kwargs):
+        super(StubIdMapper, self).__init__(api='stub', **kwargs)
+        self.queries = []
+
+    async def _query(self, object_ids):
+        self.queries.append(object_ids)
+        await asyncio.sleep(0)
+        return {i: self.MAPPING[i] for i in object_ids if i in self.MAPPING}
+
+
+def test_id_mapper_cache():
+    loop = asyncio.new_event_loop()
+    id_mapper = StubIdMapper(cache_size=3, loop=loop)
+    ids = ['MNXM1671', 'MNXM1747', 'impossible', 'MNXM1747']
+    expected = {'MNXM1671': ['itaccoa'], 'MNXM1747': ['itacon']}
+    assert loop.run_until_complete(id_mapper.bigg_ids(ids)) == expected
+    assert loop.run_until_complete(id_mapper.bigg_ids(ids)) == expected
+    assert id_mapper.queries == [['MNXM1671', 'MNXM1747', 'impossible']]
+    loop.run_until_complete(id_mapper.bigg_ids(['MNXM1251']))
+    loop.run_until_complete(id_mapper.bigg_ids(['MNXM1671']))
+    assert id_mapper.queries[1:] == [['MNXM1251'], ['MNXM1671']]
+    loop.close()
+
+
+def test_id_mapper_coalesces_concurrent_lookups():
+    loop = asyncio.new_event_loop()
+    id_mapper = StubIdMapper(loop=loop)
+    id_mapper.snapshot = {'MNXM1251': ['citmcoa__L']}
+
+    async def lookup():
+        return await asyncio.gather(
+            id_mapper.bigg_ids(['MNXM1671', 'MNXM1747']),
+            id_mapper.bigg_ids(['MNXM1747', 'MNXM1251']),
+        )
+
+    first, second = loop.run_until_complete(lookup())
+    assert first == {'MNXM1671': ['itaccoa'], 'MNXM1747': ['itacon']}
+    assert second == {'MNXM1747': ['itacon'], 'MNXM1251': ['citmcoa__L']}
+    assert id_mapper.queries == [['MNXM1671', 'MNXM1747']]
+    loop.close()
+
+
+def test_id_mapper_requires_api(monkeypatch):
+    monkeypatch.setattr(settings, 'ID_MAPPER_API', None)
+    loop = asyncio.new_event_loop()
+    with pytest.raises(KeyError):
+        IdMapper(loop=loop)
+    loop.close()
+
+
+class StubCursor(list):
+    async def to_list(self, length):
+        return list(self)
+
+
+class StubCollection(object):
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self):
+        return StubCursor(self.documents)
+
+
+class StubMongoDB(object):
+    def __init__(self):
+        self.version = 1
+        self.universal_models = StubCollection([{'_id': 'universal', 'name': 'universal'}])
+        self.models = StubCollection([{'_id': 'iJO1366', 'name': 'E. coli'}])
+        self.carbon_sources = StubCollection([{'_id': 'EX_glc_lp_e_rp_', 'name': 'EX_glc_lp_e_rp_'}])
+        self.products = StubCollection([{'_id': 'vanillin', 'name': 'vanillin', 'universal_models': ['universal']}])
+
+    async def lists_version(self):
+        return self.version
+
+
+def test_catalog_index():
+    mongodb = StubMongoDB()
+    key = dict(model_id='iJO1366', universal_model_id='universal', carbon_source_id='EX_glc_lp_e_rp_',
+               product_id='vanillin')
+
+    async def check():
+        # Built inside the coroutine, so that the index binds to the running loop
+        catalog = CatalogIndex(mongodb, ttl=3600, check_interval=3600)
+        assert await catalog.is_available(**key)
+        assert not await catalog.is_available(**dict(key, universal_model_id='other'))
+        body = await catalog.product_list_body('universal')
+        assert json.loads(body.json.decode()) == [{'id': 'vanillin', 'name': 'vanillin'}]
+        assert gzip.decompress(body.gzipped) == body.json
+        mongodb.products.documents.append({'_id': 'itacon', 'name': 'itacon', 'universal_models': ['universal']})
+        mongodb.version = 2
+        assert not await catalog.is_available(**dict(key, product_id='itacon'))
+        await catalog.refresh(force=True)
+        assert await catalog.is_available(**dict(key, product_id='itacon'))
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(check())
+    loop.close()
+
+
+def test_remote_job_runner_routes_by_model_pair():
+    addresses = ['ipc:///tmp/a', 'ipc:///tmp/b', 'ipc:///tmp/c']
+    pairs = [(m, u) for m in MODELS_IDS for u in UNIVERSAL_MODELS_IDS]
+    routes = {pair: RemoteJobRunner(addresses).address(*pair) for pair in pairs}
+    # Routing must not depend on the worker (e.g. on hash randomization), or pairs would be loaded by every server
+    assert routes == {pair: RemoteJobRunner(list(addresses)).address(*pair) for pair in pairs}
+    assert set(routes.values()) == set(addresses)
+
+
+def test_predictor_server_job_lifecycle():
+    server_connection, forker_connection = multiprocessing.Pipe()
+    key = dict(model_id='iJO1366', universal_model_id='universal', carbon_source_id='EX_glc_lp_e_rp_',
+               product_id='vanillin')
+
+    async def answer(command, error=None):
+        """Play the forker: receive the next request and answer it"""
+        while not forker_connection.poll():
+            await asyncio.sleep(0.01)
+        request_id, received_command, args = forker_connection.recv()
+        assert received_command == command
+        forker_connection.send((request_id, error))
+        return args
+
+    async def check():
+        server = PredictorServer(server_connection, max_jobs=1)
+        job = asyncio.ensure_future(server.predict(key, 'owner'))
+        assert await answer('load') == ('iJO1366', 'universal')
+        assert await answer('predict') == (key, 'owner')
+        await job
+        # The predictor is loaded once; a failed job fails the call
+        job = asyncio.ensure_future(server.predict(key, 'owner'))
+        await answer('predict', error='Prediction job exited with code 1')
+        with pytest.raises(RuntimeError):
+            await job
+        server.loop.remove_reader(server_connection.fileno())
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(asyncio.wait_for(check(), 10))
+    loop.close()
+
+
+
+def test_forker_runs_jobs(monkeypatch):
+    loaded = []
+
+    def predict_pathways(key, owner):
+        if key['product_id'] != 'vanillin':
+            raise RuntimeError("no pathways")
+
+    monkeypatch.setattr(predictor_server, 'get_predictor', lambda *pair: loaded.append(pair))
+    monkeypatch.setattr(predictor_server, 'predict_pathways', predict_pathways)
+    forker, connection = predictor_server.start_forker()
+    try:
+        connection.send((0, 'load', ('iJO1366', 'universal')))
+        connection.send((1, 'predict', (KEY, 'owner')))
+        connection.send((2, 'predict', (dict(KEY, product_id='itacon'), 'owner')))
+        replies = {}
+        while len(replies) < 3:
+            assert connection.poll(10)
+            request_id, error = connection.recv()
+            replies[request_id] = error
+        assert replies[0] is None
+        assert replies[1] is None
+        assert replies[2] == "Prediction job exited with code 1"
+    finally:
+        connection.close()
+        forker.join(10)
+    assert forker.exitcode == 0
+
+def stub_predictor(name):
+    return SimpleNamespace(name=name, model=SimpleNamespace(solver=SimpleNamespace(problem=SimpleNamespace())))
+
+
+def test_predictor_snapshot_round_trip(tmpdir):
+    PredictorSnapshot('iJO1366', 'universal', path=str(tmpdir)).dump(stub_predictor('first'))
+    snapshot = PredictorSnapshot('iJO1366', 'universal', path=str(tmpdir))
+    assert snapshot.is_fresh()
+    assert snapshot.predictor.name == 'first'
+    assert LOAD_METRICS[('iJO1366', 'universal')]['format'] == 'snapshot'
+    assert LOAD_METRICS[('iJO1366', 'universal')]['bytes'] == snapshot.size
+
+
+def test_predictor_snapshot_is_stale_for_other_versions(tmpdir, monkeypatch):
+    PredictorSnapshot('iJO1366', 'universal', path=str(tmpdir)).dump(stub_predictor('first'))
+    versions = dict(pickle_predictors.environment_versions(), cameo='0.0.0')
+    monkeypatch.setattr(pickle_predictors, 'environment_versions', lambda: versions)
+    snapshot = PredictorSnapshot('iJO1366', 'universal', path=str(tmpdir))
+    assert snapshot.header is not None
+    assert not snapshot.is_fresh()
+
+
+def test_predictor_snapshot_keeps_previous_generation(tmpdir):
+    PredictorSnapshot('iJO1366', 'universal', path=str(tmpdir)).dump(stub_predictor('first'))
+    reader = PredictorSnapshot('iJO1366', 'universal', path=str(tmpdir))
+    assert reader.is_fresh()
+    PredictorSnapshot('iJO1366', 'universal', path=str(tmpdir)).dump(stub_predictor('second'))
+    assert PredictorSnapshot('iJO1366', 'universal', path=str(tmpdir)).predictor.name == 'second'
+    assert os.path.exists(os.path.join(str(tmpdir), reader.header['payload']))
+    PredictorSnapshot('iJO1366', 'universal', path=str(tmpdir)).dump(stub_predictor('third'))
+    assert not os.path.exists(os.path.join(str(tmpdir), reader.header['payload']))
+    # The reader's generation is gone; it loads the current one instead
+    assert reader.predictor.name == 'third'
+
+
+KEY = dict(model_id='iJO1366', universal_model_id='universal', carbon_source_id='EX_glc_lp_e_rp_',
+           product_id='vanillin')
+
+
+class StubPathways(object):
+    """The parts of the pathways collection used by `AsyncPathwayCollection`, keyed by the fields of KEY"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.indexes = []
+        self.updates = []
+
+    def _key(self, document):
+        return tuple(sorted((k, document[k]) for k in KEY))
+
+    async def create_index(self, index, unique):
+        if len({self._key(document) for document in self.documents}) < len(self.documents):
+            raise DuplicateKeyError("E11000 duplicate key error")
+        self.indexes.append(index)
+
+    def aggregate(self, pipeline):
+        groups = {}
+        for document in self.documents:
+            groups.setdefault(self._key(document), []).append(document['_id'])
+        return StubCursor({'_id': dict(k), 'ids': ids, 'count': len(ids)} for k, ids in groups.items() if len(ids) > 1)
+
+    def find(self, query):
+        return StubCursor(document for document in self.documents if document['_id'] in query['_id']['$in'])
+
+    async def update_one(self, query, update, upsert=False):
+        self.updates.append((query, update, upsert))
+
+    async def find_one_and_update(self, query, update, return_document):
+        self.updates.append((query, update, return_document))
+        return self.documents[0] if self.documents else None
+
+    async def delete_many(self, query):
+        self.documents = [document for document in self.documents if document['_id'] not in query['_id']['$in']]
+
+
+def stub_pathway_collection(documents):
+    lists = SimpleNamespace(universal_model=None, model=None, carbon_source=None, product=None, version=None)
+    pathways = StubPathways(documents)
+    mongo_client = SimpleNamespace(lists=lists, pathways=SimpleNamespace(pathways=pathways))
+    return AsyncPathwayCollection(KEY, mongo_client=mongo_client), pathways
+
+
+def test_ensure_index_removes_duplicates(monkeypatch):
+    monkeypatch.setattr(AsyncPathwayCollection, '_indexed', False)
+    collection, pathways = stub_pathway_collection([
+        dict(KEY, _id=1, ready=False, pathways=[{}]),
+        dict(KEY, _id=2, ready=True, pathways=[{}, {}]),
+        dict(KEY, _id=3, ready=True, pathways=[]),
+        dict(KEY, _id=4, product_id='itacon', ready=False, pathways=[]),
+    ])
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(collection.ensure_index())
+    loop.close()
+    assert sorted(document['_id'] for document in pathways.documents) == [2, 4]
+    assert pathways.indexes == [[(k, 1) for k in sorted(KEY)]]
+    assert AsyncPathwayCollection._indexed
+
+
+def test_ensure_index_goes_on_without_index(monkeypatch):
+    monkeypatch.setattr(AsyncPathwayCollection, '_indexed', False)
+    collection, pathways = stub_pathway_collection([dict(KEY, _id=1), dict(KEY, _id=2)])
+
+    async def remove_duplicates():
+        raise RuntimeError("aggregation failed")
+
+    monkeypatch.setattr(collection, 'remove_duplicates', remove_duplicates)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(collection.ensure_index())
+    loop.close()
+    assert pathways.indexes == []
+    assert AsyncPathwayCollection._indexed
+
+
+class StubLeasedCollection(object):
+    def __init__(self):
+        self.key = KEY
+        self.heartbeats = 0
+        self.released = False
+
+    async def heartbeat(self, owner, ttl):
+        self.heartbeats += 1
+        return True
+
+    async def release(self, owner):
+        self.released = True
+
+
+@pytest.mark.parametrize('fails', [False, True])
+def test_keep_lease_until_job_is_done(monkeypatch, fails):
+    monkeypatch.setattr(settings, 'LEASE_HEARTBEAT_INTERVAL', timedelta(seconds=0.01))
+    collection = StubLeasedCollection()
+
+    async def job():
+        await asyncio.sleep(0.1)
+        if fails:
+            raise RuntimeError("worker died")
+
+    async def check():
+        task = asyncio.ensure_future(job())
+        await keep_lease(collection, 'owner', task)
+        assert task.done()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(check())
+    loop.close()
+    assert collection.heartbeats > 0
+    assert collection.released == fails
+
+
+class StubVariable(object):
+    def __init__(self, *names):
+        self.names = list(names)
+
+    def __add__(self, other):
+        return StubVariable(*(self.names + other.names))
+
+
+class StubConstraint(object):
+    def __init__(self, expression, name, ub):
+        self.expression = expression
+        self.name = name
+        self.ub = ub
+
+
+def stub_switch_predictor(reaction_ids):
+    variables = {'y_' + reaction_id: StubVariable('y_' + reaction_id) for reaction_id in reaction_ids}
+    solver = SimpleNamespace(variables=variables, interface=SimpleNamespace(Constraint=StubConstraint))
+    return SimpleNamespace(model=SimpleNamespace(solver=solver))
+
+
+def stored_pathway(*reaction_ids):
+    return {'model': {'reactions': [{'id': reaction_id} for reaction_id in reaction_ids]}}
+
+
+def test_exclusion_cuts():
+    predictor = stub_switch_predictor(['R1', 'R2', 'R3'])
+    cuts = exclusion_cuts(predictor, [stored_pathway('R1', 'R2'), stored_pathway('R3')])
+    assert [(cut.name, cut.expression.names, cut.ub) for cut in cuts] == [
+        ('resume_cut_0', ['y_R1', 'y_R2'], 1),
+        ('resume_cut_1', ['y_R3'], 0),
+    ]
+    with pytest.raises(NotResumable):
+        exclusion_cuts(predictor, [stored_pathway('R1', 'R4')])
+
+
+class StubPathwayCollection(object):
+    """In-memory `PathwayCollection` of a single document"""
+
+    def __init__(self, document):
+        self.key = KEY
+        self.document = document
+        self.restarts = 0
+
+    def find(self):
+        return self.document
+
+    def set_exhausted(self):
+        self.document['exhausted'] = True
+
+    def set_ready(self, max_predictions):
+        if self.document['max_predictions'] > max_predictions:
+            return False
+        self.document.update(ready=True, lease=None)
+        return True
+
+    def restart(self):
+        self.restarts += 1
+        self.document.update(pathways=[], exhausted=False)
+
+    def release(self):
+        self.document['lease'] = None
+
+
+class StubHeartbeat(object):
+    lost = False
+
+    def __init__(self, mongo_client):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def run_prediction_job(monkeypatch, collection, extend_enumeration):
+    monkeypatch.setattr(prediction, 'PathwayCollection', lambda key, owner, mongo_client: collection)
+    monkeypatch.setattr(prediction, 'get_mongo_client', lambda: None)
+    monkeypatch.setattr(prediction, 'Heartbeat', StubHeartbeat)
+    monkeypatch.setattr(prediction, 'extend_enumeration', extend_enumeration)
+    prediction.predict_pathways(KEY, 'owner')
+
+
+def test_predict_pathways_restarts_when_not_resumable(monkeypatch):
+    predictor = stub_switch_predictor(['R1', 'R2'])
+    collection = StubPathwayCollection({'pathways': [stored_pathway('R1', 'R9')], 'max_predictions': 2,
+                                        'lease': {'owner': 'owner'}})
+
+    def extend_enumeration(mongo_client, heartbeat, stored_pathways, max_predictions):
+        exclusion_cuts(predictor, stored_pathways)
+        for _ in range(len(stored_pathways), max_predictions):
+            mongo_client.document['pathways'].append(stored_pathway('R1', 'R2'))
+        return max_predictions - len(stored_pathways)
+
+    run_prediction_job(monkeypatch, collection, extend_enumeration)
+    assert collection.restarts == 1
+    assert collection.document['pathways'] == [stored_pathway('R1', 'R2')] * 2
+    assert collection.document['ready']
+
+
+def test_prediction_is_ready():
+    assert not prediction_is_ready(None, 2)
+    assert prediction_is_ready({'pathways': [{}, {}], 'ready': False}, 2)
+    assert not prediction_is_ready({'pathways': [{}], 'ready': False}, 2)
+    assert not prediction_is_ready({'pathways': [{}], 'ready': True}, 2)
+    assert not prediction_is_ready({'pathways': [{}], 'ready': False, 'exhausted': True}, 2)
+    assert prediction_is_ready({'pathways': [{}], 'ready': True, 'exhausted': True}, 2)
+
+
+def test_parse_max_predictions():
+    assert parse_max_predictions('5') == 5
+    assert parse_max_predictions(settings.MAX_PREDICTIONS_LIMIT) == settings.MAX_PREDICTIONS_LIMIT
+    for value in ['0', settings.MAX_PREDICTIONS_LIMIT + 1, 'five', None, [5], {'n': 5}]:
+        with pytest.raises(ValueError):
+            parse_max_predictions(value)
+
+
+def test_claim_query(monkeypatch):
+    monkeypatch.setattr(AsyncPathwayCollection, '_indexed', True)
+    collection, pathways = stub_pathway_collection([])
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(collection.claim('owner', settings.LEASE_TTL, 3)) is None
+    loop.close()
+    (upsert_query, upsert, is_upsert), (query, update, _) = pathways.updates
+    assert upsert_query == KEY and is_upsert
+    assert upsert['$max'] == {'max_predictions': 3}
+    assert upsert['$setOnInsert']['lease'] is None
+    timestamp = update['$set']['updated']
+    assert query == dict(KEY, **{
+        'pathways.2': {'$exists': False},
+        'exhausted': {'$ne': True},
+        '$or': [{'lease': None}, {'lease.expires': {'$lt': timestamp}}],
+    })
+    assert update['$set']['lease'] == {'owner': 'owner', 'expires': timestamp + settings.LEASE_TTL}
+    assert update['$set']['ready'] is False
+
+
+def test_predict_pathways_stops_when_exhausted(monkeypatch):
+    collection = StubPathwayCollection({'pathways': [stored_pathway('R1')], 'max_predictions': 5,
+                                        'lease': {'owner': 'owner'}})
+    calls = []
+
+    def extend_enumeration(mongo_client, heartbeat, stored_pathways, max_predictions):
+        calls.append((len(stored_pathways), max_predictions))
+        mongo_client.document['pathways'].append(stored_pathway('R2'))
+        return 1
+
+    run_prediction_job(monkeypatch, collection, extend_enumeration)
+    assert calls == [(1, 5)]
+    assert collection.document['exhausted']
+    assert collection.document['ready']
+    assert collection.document['lease'] is None
+
+
+def test_predict_pathways_picks_up_raised_target(monkeypatch):
+    collection = StubPathwayCollection({'pathways': [], 'max_predictions': 1, 'lease': {'owner': 'owner'}})
+    set_ready = collection.set_ready
+    calls = []
+
+    def raise_target_then_set_ready(max_predictions):
+        # A request raises the target right before the job marks the key as ready
+        collection.document['max_predictions'] = 2
+        calls.append(('set_ready', max_predictions))
+        return set_ready(max_predictions)
+
+    def extend_enumeration(mongo_client, heartbeat, stored_pathways, max_predictions):
+        calls.append(('extend', len(stored_pathways), max_predictions))
+        for _ in range(len(stored_pathways), max_predictions):
+            mongo_client.document['pathways'].append(stored_pathway('R1'))
+        return max_predictions - len(stored_pathways)
+
+    collection.set_ready = raise_target_then_set_ready
+    run_prediction_job(monkeypatch, collection, extend_enumeration)
+    assert calls == [('extend', 0, 1), ('set_ready', 1), ('extend', 1, 2), ('set_ready', 2)]
+    assert len(collection.document['pathways']) == 2
+    assert collection.document['ready']
+
+
+def test_predict_pathways_stops_when_lease_is_lost(monkeypatch):
+    collection = StubPathwayCollection({'pathways': [], 'max_predictions': 1, 'lease': {'owner': 'other'}})
+    with pytest.raises(LeaseLost):
+        run_prediction_job(monkeypatch, collection, None)